@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 import sys
+import io
 import os
-import glob
 import re
-import subprocess
+import struct
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Page(object):
@@ -12,12 +13,19 @@ class Page(object):
         self.filename = filename
         self.children = children or []
 
-    def render(self, output, depth=0):
-        indent = "  " * depth
-        bullet = "- " if depth > 0 else ""
-        output.write(f"{indent}{bullet}[{self.title}]({self.filename})\n")
-        for kid in self.children:
-            kid.render(output, depth + 1)
+
+def write_if_changed(filename, content):
+    """Write content to filename, leaving the file untouched if it
+    already holds exactly that content, so that its mtime doesn't
+    cause needless rebuilds"""
+    try:
+        with open(filename) as f:
+            if f.read() == content:
+                return
+    except FileNotFoundError:
+        pass
+    with open(filename, "w") as f:
+        f.write(content)
 
 
 # autogenerate an index page from the contents of a directory
@@ -27,68 +35,45 @@ class Gen(object):
         self.dirname = dirname
         self.index = index
 
-    def render(self, output, depth=0):
-        print(self.dirname)
-        names = sorted(glob.glob(f"{self.dirname}/*.md"))
-        children = []
-        for filename in names:
-            title = os.path.basename(filename).rsplit(".", 1)[0]
-            if title == "index":
-                continue
-            children.append(Page(title, filename))
+    def page(self):
+        if os.environ.get("DOCS_VERBOSE"):
+            print(self.dirname, file=sys.stderr)
+        names = sorted(
+            e.name
+            for e in os.scandir(self.dirname)
+            if e.is_file() and e.name.endswith(".md") and e.name != "index.md"
+        )
+        children = [
+            Page(os.path.splitext(name)[0], f"{self.dirname}/{name}") for name in names
+        ]
 
         index_filename = f"{self.dirname}/index.md"
         index_page = Page(self.title, index_filename, children=children)
-        index_page.render(output, depth)
-        with open(f"{self.dirname}/index.md", "w") as idx:
-            if self.index:
-                idx.write(self.index)
-                idx.write("\n\n")
-            for page in children:
-                idx.write(f"  - [{page.title}]({page.title}.md)\n")
+        idx = io.StringIO()
+        if self.index:
+            idx.write(self.index)
+            idx.write("\n\n")
+        for page in children:
+            idx.write(f"  - [{page.title}]({page.title}.md)\n")
+        write_if_changed(index_filename, idx.getvalue())
+        return index_page
 
 
 def image_dimensions(filename):
-    try:
-        out = subprocess.check_output(["identify", filename])
-        fields = out.split()
-        while fields[0] != b"PNG":
-            fields = fields[1:]
-        return [int(x) for x in fields[1].split(b"x")]
-    except FileNotFoundError:
+    """Returns the [width, height] of a PNG image, read directly from
+    its IHDR chunk, which the PNG spec requires to come first"""
+    with open(filename, "rb") as f:
+        header = f.read(24)
+    if len(header) < 24 or header[:8] != b"\x89PNG\r\n\x1a\n":
         return [100, 100]
+    return list(struct.unpack(">II", header[16:24]))
 
 
-class GenColorScheme(object):
-    def __init__(self, title, dirname, index=None):
-        self.title = title
-        self.dirname = dirname
-        self.index = index
+SCHEME_TEMPLATE = """# {title}
+<img width="{width}" height="{height}" src="{img}" alt="{title}">
 
-    def render(self, output, depth=0):
-        names = sorted(glob.glob(f"{self.dirname}/*"))
-        children = []
-        for scheme_prefix in names:
-            title = os.path.basename(scheme_prefix).rsplit(".", 1)[0]
-            if title == "index":
-                continue
+To use this scheme, add this to your config:
 
-            scheme_filename = f"{scheme_prefix}/index.md"
-            children.append(Page(title, scheme_filename))
-
-            with open(scheme_filename, "w") as idx:
-                images = sorted(glob.glob(f"{scheme_prefix}/*.png"))
-                for img in images:
-                    width, height = image_dimensions(img)
-                    img = os.path.basename(img)
-                    title = os.path.basename(img).rsplit(".", 1)[0]
-                    idx.write(f"# {title}\n")
-                    idx.write(
-                        f'<img width="{width}" height="{height}" src="{img}" alt="{title}">\n\n'
-                    )
-                    idx.write("To use this scheme, add this to your config:\n")
-                    idx.write(
-                        f"""
 ```lua
 return {{
   color_scheme = "{title}",
@@ -96,17 +81,93 @@ return {{
 ```
 
 """
-                    )
+
+
+def render_prefix(scheme_prefix):
+    """Returns the content of the index page for a color scheme prefix
+    directory, with a section for each screenshot that it contains,
+    or an empty string if there are no screenshots at all."""
+    images = sorted(
+        e.name
+        for e in os.scandir(scheme_prefix)
+        if e.is_file() and e.name.endswith(".png")
+    )
+    if not images:
+        return ""
+
+    idx = io.StringIO()
+    for img in images:
+        width, height = image_dimensions(f"{scheme_prefix}/{img}")
+        title = os.path.splitext(img)[0]
+        idx.write(
+            SCHEME_TEMPLATE.format_map(
+                {"title": title, "img": img, "width": width, "height": height}
+            )
+        )
+    return idx.getvalue()
+
+
+class GenColorScheme(object):
+    def __init__(self, title, dirname, index=None):
+        self.title = title
+        self.dirname = dirname
+        self.index = index
+
+    def page(self):
+        prefixes = sorted(e.name for e in os.scandir(self.dirname) if e.is_dir())
+        scheme_prefixes = [f"{self.dirname}/{prefix}" for prefix in prefixes]
+
+        # The prefix directories are independent of each other and most
+        # of the time is spent reading screenshots, so generate their
+        # pages concurrently; the files are written out from here.
+        with ThreadPoolExecutor() as pool:
+            texts = pool.map(render_prefix, scheme_prefixes)
+
+        children = []
+        for prefix, scheme_prefix, text in zip(prefixes, scheme_prefixes, texts):
+            if text == "":
+                # Don't create or link to a page with nothing on it
+                continue
+            scheme_filename = f"{scheme_prefix}/index.md"
+            children.append(Page(prefix, scheme_filename))
+            write_if_changed(scheme_filename, text)
 
         index_filename = f"{self.dirname}/index.md"
         index_page = Page(self.title, index_filename, children=children)
-        index_page.render(output, depth)
-
-        with open(f"{self.dirname}/index.md", "w") as idx:
-            idx.write("Color schemes listed by first letter\n\n")
-            for page in children:
-                upper = page.title.upper()
-                idx.write(f"  - [{upper}]({page.title}/index.md)\n")
+        idx = io.StringIO()
+        idx.write("Color schemes listed by first letter\n\n")
+        for page in children:
+            upper = page.title.upper()
+            idx.write(f"  - [{upper}]({page.title}/index.md)\n")
+        write_if_changed(index_filename, idx.getvalue())
+        return index_page
+
+
+def summary_lines(toc, pool):
+    """Returns the lines of SUMMARY.md for the pages in toc.
+    The Gen and GenColorScheme nodes are the slow part and don't depend
+    on each other, so the pages that they generate are produced
+    concurrently on pool before walking the tree."""
+    generators = []
+    stack = list(toc)
+    while stack:
+        page = stack.pop()
+        if isinstance(page, Page):
+            stack += page.children
+        else:
+            generators.append(page)
+    generated = dict(zip(generators, pool.map(lambda gen: gen.page(), generators)))
+
+    lines = []
+    stack = [(page, 0) for page in reversed(toc)]
+    while stack:
+        page, depth = stack.pop()
+        page = generated.get(page, page)
+        indent = "  " * depth
+        bullet = "- " if depth > 0 else ""
+        lines.append(f"{indent}{bullet}[{page.title}]({page.filename})\n")
+        stack += [(kid, depth + 1) for kid in reversed(page.children)]
+    return lines
 
 
 TOC = [
@@ -271,6 +332,7 @@ The following events can be handled using [wezterm.on](../wezterm/on.md):
 ]
 
 os.chdir("docs")
+with ThreadPoolExecutor() as pool:
+    lines = summary_lines(TOC, pool)
 with open("SUMMARY.md", "w") as f:
-    for page in TOC:
-        page.render(f)
+    f.write("".join(lines))
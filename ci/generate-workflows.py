@@ -1,7 +1,17 @@
 #!/usr/bin/env python3
+import hashlib
+import io
 import os
 import sys
 
+try:
+    import yaml
+
+    # Prefer the libyaml based loader where pyyaml was built with it
+    YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+except ImportError:
+    yaml = None
+
 
 def yv(v):
     if v is True:
@@ -21,11 +31,15 @@ def yv(v):
 
 
 class Step(object):
+    __slots__ = ()
+
     def render(self, f, env):
         raise NotImplementedError(repr(self))
 
 
 class RunStep(Step):
+    __slots__ = ("name", "run", "shell")
+
     def __init__(self, name, run, shell="bash"):
         self.name = name
         self.run = run
@@ -47,6 +61,8 @@ class RunStep(Step):
 
 
 class ActionStep(Step):
+    __slots__ = ("name", "action", "params", "env")
+
     def __init__(self, name, action, params=None, env=None):
         self.name = name
         self.action = action
@@ -67,25 +83,43 @@ class ActionStep(Step):
 
 
 class CacheStep(ActionStep):
+    __slots__ = ()
+
     def __init__(self, name, path, key):
         super().__init__(
-            name, action="actions/cache@v2.1.6", params={"path": path, "key": key}
+            name, action="actions/cache@v3", params={"path": path, "key": key}
         )
 
 
 class CheckoutStep(ActionStep):
+    __slots__ = ()
+
     def __init__(self, name="checkout repo"):
         super().__init__(
             name, action="actions/checkout@v2", params={"submodules": "recursive"}
         )
 
 
+# Upper bound on a single generated job; GitHub's own default is 360.
+# This leaves room for a cold build with an empty cargo cache, which on
+# the bootstrap_git targets also has to build git from source.
+DEFAULT_TIMEOUT_MINUTES = 60
+
+
 class Job(object):
-    def __init__(self, runs_on, container=None, steps=None, env=None):
+    def __init__(
+        self,
+        runs_on,
+        container=None,
+        steps=None,
+        env=None,
+        timeout_minutes=DEFAULT_TIMEOUT_MINUTES,
+    ):
         self.runs_on = runs_on
         self.container = container
         self.steps = steps
         self.env = env
+        self.timeout_minutes = timeout_minutes
 
     def render(self, f):
         for s in self.steps:
@@ -102,6 +136,7 @@ class Target(object):
         rust_target=None,
         continuous_only=False,
         app_image=False,
+        timeout_minutes=DEFAULT_TIMEOUT_MINUTES,
     ):
         if not name:
             if container:
@@ -115,25 +150,30 @@ class Target(object):
         self.rust_target = rust_target
         self.continuous_only = continuous_only
         self.app_image = app_image
+        self.timeout_minutes = timeout_minutes
+
+        # These are consulted by most of the step helpers below, so
+        # work them out once from the name rather than on every call
+        self._uses_yum = "fedora" in self.name or "centos" in self.name
+        self._uses_apt = "ubuntu" in self.name or "debian" in self.name
+        self._needs_sudo = not self.container and self._uses_apt
+        self._is_windows = "win" in self.name
+        self._is_macos = "mac" in self.name
 
     def uses_yum(self):
-        if "fedora" in self.name:
-            return True
-        if "centos" in self.name:
-            return True
-        return False
+        return self._uses_yum
 
     def uses_apt(self):
-        if "ubuntu" in self.name:
-            return True
-        if "debian" in self.name:
-            return True
-        return False
+        return self._uses_apt
 
     def needs_sudo(self):
-        if not self.container and self.uses_apt():
-            return True
-        return False
+        return self._needs_sudo
+
+    def is_windows(self):
+        return self._is_windows
+
+    def is_macos(self):
+        return self._is_macos
 
     def install_system_package(self, name):
         installer = None
@@ -156,28 +196,39 @@ class Target(object):
         steps = []
         if self.bootstrap_git:
             GIT_VERS = "2.26.2"
-            steps.append(
-                CacheStep(
-                    "Cache Git installation",
-                    path="/usr/local/git",
-                    key=f"{self.name}-git-{GIT_VERS}",
-                )
-            )
 
+            # The compiler, make and perl are needed by later steps as
+            # well, so they are installed even when git comes from the
+            # cache; the rest are only needed to build git itself
+            tool_reqs = ""
             pre_reqs = ""
             if self.uses_yum():
+                tool_reqs = "yum install -y gcc make perl"
                 pre_reqs = "yum install -y wget curl-devel expat-devel gettext-devel openssl-devel zlib-devel gcc perl-ExtUtils-MakeMaker make"
             elif self.uses_apt():
+                tool_reqs = "apt-get install -y gcc make perl"
                 pre_reqs = "apt-get install -y wget libcurl4-openssl-dev libexpat-dev gettext libssl-dev libz-dev gcc libextutils-autoinstall-perl make"
 
+            # The build prerequisites are part of the key so that changing
+            # them produces a fresh build rather than restoring a git that
+            # was built against the old set
+            pre_reqs_hash = hashlib.sha256(pre_reqs.encode("utf-8")).hexdigest()[:8]
+            steps.append(
+                CacheStep(
+                    "Cache Git installation",
+                    path="/usr/local/git",
+                    key=f"{self.name}-git-{GIT_VERS}-{pre_reqs_hash}",
+                )
+            )
+
             steps.append(
                 RunStep(
                     name="Install Git from source",
                     shell="bash",
                     run=f"""
-{pre_reqs}
-
+{tool_reqs}
 if test ! -x /usr/local/git/bin/git ; then
+    {pre_reqs}
     cd /tmp
     wget https://github.com/git/git/archive/v{GIT_VERS}.tar.gz
     tar xzf v{GIT_VERS}.tar.gz
@@ -196,8 +247,6 @@ ln -s /usr/local/git/bin/git /usr/local/bin/git
         return steps
 
     def install_rust(self, cache=True):
-        salt = "2"
-        key_prefix = f"{self.name}-{self.rust_target}-{salt}-${{{{ runner.os }}}}-${{{{ hashFiles('**/Cargo.lock') }}}}"
         params = {
             "profile": "minimal",
             "toolchain": "stable",
@@ -214,23 +263,24 @@ ln -s /usr/local/git/bin/git /usr/local/bin/git
                 env={"ACTIONS_ALLOW_UNSECURE_COMMANDS": "true"},
             ),
         ]
-        if "macos" in self.name:
+        if self.is_macos():
             steps += [
                 RunStep(name="Install Rust (ARM)", run="rustup target add aarch64-apple-darwin")
             ]
         if cache:
-            cache_paths = ["~/.cargo/registry", "~/.cargo/git", "target"]
+            # rust-cache keys on the rustc version and Cargo.lock itself,
+            # and prunes stale artifacts from target before saving
             steps += [
-                CacheStep(
+                ActionStep(
                     name="Cache cargo",
-                    path="\n".join(cache_paths),
-                    key=f"{key_prefix}-cargo",
+                    action="Swatinem/rust-cache@v2",
+                    params={"key": self.name},
                 ),
             ]
         return steps
 
     def install_system_deps(self):
-        if "win" in self.name:
+        if self.is_windows():
             return []
         sudo = "sudo -n " if self.needs_sudo() else ""
         return [RunStep(name="Install System Deps", run=f"{sudo} env PATH=$PATH ./get-deps")]
@@ -239,7 +289,7 @@ ln -s /usr/local/git/bin/git /usr/local/bin/git
         return [RunStep(name="Check formatting", run="cargo fmt --all -- --check")]
 
     def build_all_release(self):
-        if "win" in self.name:
+        if self.is_windows():
             return [
                 RunStep(
                     name="Build (Release mode)",
@@ -249,7 +299,7 @@ PATH C:\\Strawberry\\perl\\bin;%PATH%
 cargo build --all --release""",
                 )
             ]
-        if "macos" in self.name:
+        if self.is_macos():
             return [
                 RunStep(
                     name="Build (Release mode Intel)",
@@ -261,7 +311,7 @@ cargo build --all --release""",
         return [RunStep(name="Build (Release mode)", run="cargo build --all --release")]
 
     def test_all_release(self):
-        if "macos" in self.name:
+        if self.is_macos():
             return [RunStep(name="Test (Release mode)", run="cargo test --target x86_64-apple-darwin --all --release")]
         return [RunStep(name="Test (Release mode)", run="cargo test --all --release")]
 
@@ -276,11 +326,11 @@ cargo build --all --release""",
         run = "mkdir pkg_\n"
         if self.uses_yum():
             run += "mv ~/rpmbuild/RPMS/*/*.rpm pkg_\n"
-        if "win" in self.name:
+        if self.is_windows():
             run += "mv *.zip *.exe pkg_\n"
-        if "mac" in self.name:
+        if self.is_macos():
             run += "mv *.zip pkg_\n"
-        if ("ubuntu" in self.name) or ("debian" in self.name):
+        if self.uses_apt():
             run += "mv *.deb *.xz pkg_\n"
         if self.app_image:
             run += "mv *.AppImage *.zsync pkg_\n"
@@ -298,11 +348,11 @@ cargo build --all --release""",
         patterns = []
         if self.uses_yum():
             patterns += ["wezterm-*.rpm"]
-        elif "win" in self.name:
+        elif self.is_windows():
             patterns += ["WezTerm-*.zip", "WezTerm-*.exe"]
-        elif "mac" in self.name:
+        elif self.is_macos():
             patterns += ["WezTerm-*.zip"]
-        elif ("ubuntu" in self.name) or ("debian" in self.name):
+        elif self.uses_apt():
             patterns += ["wezterm-*.deb", "wezterm-*.xz", "wezterm-*.tar.gz"]
 
         if self.app_image:
@@ -356,7 +406,7 @@ cargo build --all --release""",
 
     def update_homebrew_tap(self):
         steps = []
-        if "macos" in self.name:
+        if self.is_macos():
             steps += [
                 ActionStep(
                     "Checkout homebrew tap",
@@ -409,7 +459,7 @@ cargo build --all --release""",
 
     def global_env(self):
         env = {}
-        if "macos" in self.name:
+        if self.is_macos():
             env["MACOSX_DEPLOYMENT_TARGET"] = "10.9"
         return env
 
@@ -449,7 +499,7 @@ cargo build --all --release""",
             ),
             RunStep("Fetch tag/branch history", "git fetch --prune --unshallow"),
         ]
-        steps += self.install_rust(cache="mac" not in self.name)
+        steps += self.install_rust(cache=not self.is_macos())
         steps += self.install_system_deps()
         return steps
 
@@ -465,6 +515,7 @@ cargo build --all --release""",
             container=self.container,
             steps=steps,
             env=self.global_env(),
+            timeout_minutes=self.timeout_minutes,
         )
 
     def continuous(self):
@@ -482,6 +533,7 @@ cargo build --all --release""",
             container=self.container,
             steps=steps,
             env=env,
+            timeout_minutes=self.timeout_minutes,
         )
 
     def tag(self):
@@ -498,6 +550,7 @@ cargo build --all --release""",
             container=self.container,
             steps=steps,
             env=env,
+            timeout_minutes=self.timeout_minutes,
         )
 
 
@@ -509,23 +562,58 @@ TARGETS = [
     # Target(container="debian:8.11", continuous_only=True, bootstrap_git=True),
     Target(container="debian:9.12", continuous_only=True, bootstrap_git=True),
     Target(container="debian:10.3", continuous_only=True),
-    Target(name="macos", os="macos-11.0"),
+    # macOS builds for two architectures without a cargo cache
+    Target(name="macos", os="macos-11.0", timeout_minutes=90),
     Target(container="fedora:31"),
     Target(container="fedora:32"),
     Target(container="fedora:33"),
     Target(container="fedora:34"),
     Target(container="centos:7", bootstrap_git=True),
     Target(container="centos:8"),
-    Target(name="windows", os="vs2017-win2016", rust_target="x86_64-pc-windows-msvc"),
+    Target(
+        name="windows",
+        os="vs2017-win2016",
+        rust_target="x86_64-pc-windows-msvc",
+        timeout_minutes=90,
+    ),
 ]
 
 
+WORKFLOW_HEADER = """
+name: {name}
+{concurrency}{trigger}
+
+jobs:
+  build:
+    strategy:
+      fail-fast: false
+    runs-on: {runs_on}
+    timeout-minutes: {timeout_minutes}
+    {container}
+    steps:
+"""
+
+
+def write_if_changed(file_name, content):
+    """Write content to file_name unless it already holds exactly that
+    content, so that unchanged workflows keep their mtime.
+    Returns True if the file was written."""
+    try:
+        with open(file_name) as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(file_name, "w") as f:
+        f.write(content)
+    return True
+
+
 def generate_actions(namer, jobber, trigger, is_continuous):
     for t in TARGETS:
         # if t.continuous_only and not is_continuous:
         #    continue
         name = namer(t).replace(":", "")
-        print(name)
         job = jobber(t)
 
         file_name = f".github/workflows/gen_{name}.yml"
@@ -534,32 +622,36 @@ def generate_actions(namer, jobber, trigger, is_continuous):
         else:
             container = ""
 
-        with open(file_name, "w") as f:
-            f.write(
-                f"""
-name: {name}
-{trigger}
-
-jobs:
-  build:
-    strategy:
-      fail-fast: false
-    runs-on: {yv(job.runs_on)}
-    {container}
-    steps:
-"""
+        if is_continuous:
+            concurrency = ""
+        else:
+            # A new push to a PR supersedes any run still in flight for it
+            concurrency = f"concurrency:\n  group: {name}-${{{{ github.ref }}}}\n  cancel-in-progress: true\n"
+
+        f = io.StringIO()
+        f.write(
+            WORKFLOW_HEADER.format_map(
+                {
+                    "name": name,
+                    "concurrency": concurrency,
+                    "trigger": trigger,
+                    "runs_on": yv(job.runs_on),
+                    "timeout_minutes": job.timeout_minutes,
+                    "container": container,
+                }
             )
-
-            job.render(f)
+        )
+        job.render(f)
+        content = f.getvalue()
 
         # Sanity check the yaml, if pyyaml is available
-        try:
-            import yaml
+        if yaml is not None:
+            yaml.load(content, Loader=YamlLoader)
 
-            with open(file_name) as f:
-                yaml.safe_load(f)
-        except ImportError:
-            pass
+        if write_if_changed(file_name, content):
+            print(f"[updated] {name}")
+        else:
+            print(f"[unchanged] {name}")
 
 
 def generate_pr_actions():
@@ -573,7 +665,7 @@ on:
     - main
     paths-ignore:
     - '.cirrus.yml'
-    - 'docs/*'
+    - 'docs/**'
     - 'ci/build-docs.sh'
     - 'ci/generate-docs.py'
     - 'ci/subst-release-info.py'